@@ -1,13 +1,31 @@
 import logging
+import re
+import sys
+import threading
 import time
-from tqdm import tqdm
-import numpy as np
+from typing import Iterator, Sequence
 from qcodes.instrument.visa import VisaInstrument
 from qcodes.utils import validators as vals
 
 log = logging.getLogger(__name__)
 visalog = logging.getLogger('qcodes.instrument.visa')
 
+# Numeric value at the end of a reply, followed by its (optional) unit,
+# e.g. 'STAT:DEV:GRPZ:PSU:SIG:FLD:0.1000T' or '...:SIG:RFST:0.2000T/m'
+_NUM_RE = re.compile(r':([-+0-9.eE]+)[A-Za-z/]*$')
+# Ramp status as reported by the instrument and its readable name
+_ACTN_REV = {'RTOS': 'TO SET',
+             'HOLD': 'HOLD',
+             'CLMP': 'CLAMP',
+             'RTOZ': 'TO ZERO'}
+_ACTN_FWD = {v: k for k, v in _ACTN_REV.items()}
+def _fmt(value) -> str:
+    """Format a numeric setpoint, also accepting numeric strings"""
+    return format(float(value), '.6g')
+
+# Clears leftovers of a longer previous status line
+_PAD = 30 * ' '
+
 class MercuryiPS(VisaInstrument):
     """
     @Author: David Barcons (ICFO, Barcelona, Feb 2023)
@@ -32,58 +50,97 @@ class MercuryiPS(VisaInstrument):
                          **kwargs)
         #Set magnet quench temperature default limit
         self.t_limit = 5.0
+        # Replies to READ commands are reused for read_ttl seconds, so bursts
+        # of getter calls cost a single round-trip. Any SET clears them.
+        self.read_ttl = 0.05
+        self._reply_cache = {}
+        # Time of the last ramp status print, see _print_field_status
+        self._last_print = 0.0
         #We only have z-axis magnet
         self.psu_string = 'PSU'
         self.uid = 'GRPZ'
+        # Serializes all instrument I/O (single queries in ask_raw and
+        # pipelined batches in _submit), so replies stay paired with their
+        # commands if the driver is shared between threads
+        self._io_lock = threading.RLock()
+        # All command strings are built once here, so getting or setting a
+        # parameter does no string formatting beyond appending the value
+        psu = f'DEV:{self.uid}:{self.psu_string}'
+        self._cmd = {
+            'volt_get': f'READ:{psu}:SIG:VOLT',
+            'curr_get': f'READ:{psu}:SIG:CURR',
+            'pcur_get': f'READ:{psu}:SIG:PCUR',
+            'cset_get': f'READ:{psu}:SIG:CSET',
+            'fset_get': f'READ:{psu}:SIG:FSET',
+            'fset_set': f'SET:{psu}:SIG:FSET:',
+            'rcst_get': f'READ:{psu}:SIG:RCST',
+            'rfst_get': f'READ:{psu}:SIG:RFST',
+            'rfst_set': f'SET:{psu}:SIG:RFST:',
+            'fld_get': f'READ:{psu}:SIG:FLD',
+            'pfld_get': f'READ:{psu}:SIG:PFLD',
+            'atob_get': f'READ:{psu}:ATOB',
+            'atob_set': f'SET:{psu}:ATOB:',
+            'actn_get': f'READ:{psu}:ACTN',
+            'actn_set': f'SET:{psu}:ACTN:',
+            'swht_get': f'READ:{psu}:SIG:SWHT',
+            'swht_set': f'SET:{psu}:SIG:SWHT:',
+            'temp_get': 'READ:DEV:MB1.T1:TEMP:SIG:TEMP',
+        }
+        # Signals polled together while ramping
+        self._read_cmds = {
+            'ACTN': self._cmd['actn_get'],
+            'TEMP': self._cmd['temp_get'],
+            'FLD': self._cmd['fld_get'],
+        }
         
         self.add_parameter('voltage',
                            label='Output voltage',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:VOLT',
+                           get_cmd=self._cached_get(self._cmd['volt_get']),
                            unit='V',
                            get_parser=self._singleunit_parser)
 
         self.add_parameter('current',
                            label='Output current',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:CURR',
+                           get_cmd=self._cached_get(self._cmd['curr_get']),
                            unit='A',
                            get_parser=self._singleunit_parser)
 
         self.add_parameter('current_persistent',
                            label='Output persistent current',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:PCUR',
+                           get_cmd=self._cached_get(self._cmd['pcur_get']),
                            unit='A',
                            get_parser=self._singleunit_parser)
 
         self.add_parameter('current_target',
                            label='Target current',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:CSET',
+                           get_cmd=self._cached_get(self._cmd['cset_get']),
                            unit='A',
                            get_parser=self._singleunit_parser)
 
         self.add_parameter('field_target',
                            label='Target field',
                            unit='T',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:FSET',
-                           set_cmd=lambda x: self.ask(f'SET:DEV:{self.uid}:{self.psu_string}:SIG:FSET:{str(x)}'),
+                           get_cmd=self._cached_get(self._cmd['fset_get']),
+                           set_cmd=lambda x: self._set(self._fset_cmd(x)),
                            get_parser=self._singleunit_parser)
 
         self.add_parameter('current_ramp_rate',
                            label='Ramp rate (current)',
                            unit='A/min',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:RCST',
+                           get_cmd=self._cached_get(self._cmd['rcst_get']),
                            get_parser=self._rate_parser)
 
         self.add_parameter('field_ramp_rate',
                            label='Ramp rate (field)',
                            unit='T/min',
-                           set_cmd=lambda x: self.ask(f'SET:DEV:{self.uid}:{self.psu_string}:SIG:RFST:{str(x)}'),
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:RFST',
+                           set_cmd=lambda x: self._set(self._cmd['rfst_set'] + _fmt(x)),
+                           get_cmd=self._cached_get(self._cmd['rfst_get']),
                            get_parser=self._rate_parser)
 
         self.add_parameter('field',
                            label='Field strength',
                            unit='T',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:FLD',
+                           get_cmd=self._cached_get(self._cmd['fld_get']),
                            get_parser=self._singleunit_parser,
                            set_cmd = lambda x: self.set_field_and_ramp_blocking(x),
                            vals=vals.Numbers(min_value = -7.0, max_value = 7.0))
@@ -91,30 +148,27 @@ class MercuryiPS(VisaInstrument):
         self.add_parameter('field_persistent',
                            label='Persistent field strength',
                            unit='T',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:PFLD',
+                           get_cmd=self._cached_get(self._cmd['pfld_get']),
                            get_parser=self._singleunit_parser)
 
         self.add_parameter('ATOB',
                            label='Current to field ratio',
                            unit='A/T',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:ATOB',
+                           get_cmd=self._cached_get(self._cmd['atob_get']),
                            get_parser=self._rate_parser,
-                           set_cmd=lambda x: self.ask(f'SET:DEV:{self.uid}:{self.psu_string}:ATOB:{str(x)}'))
+                           set_cmd=lambda x: self._set(self._cmd['atob_set'] + _fmt(x)))
 
         self.add_parameter('ramp_status',
                            label='Ramp status',
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:ACTN',
-                           get_parser=self._preparser,
-                           set_cmd=lambda x: self.ask(f'SET:DEV:{self.uid}:{self.psu_string}:ACTN:{str(x)}'),
-                           val_mapping={'HOLD': 'HOLD',
-                                        'TO SET': 'RTOS',
-                                        'CLAMP': 'CLMP',
-                                        'TO ZERO': 'RTOZ'})
+                           get_cmd=self._cached_get(self._cmd['actn_get']),
+                           get_parser=self._actn_parser,
+                           set_cmd=lambda x: self._set(self._cmd['actn_set'] + _ACTN_FWD[x]),
+                           vals=vals.Enum(*_ACTN_FWD))
                                       
         self.add_parameter(name="temp",
                            label="Magnet Temperature",
                            unit="K",
-                           get_cmd=f'READ:DEV:MB1.T1:TEMP:SIG:TEMP',
+                           get_cmd=self._cached_get(self._cmd['temp_get']),
                            get_parser = self._singleunit_parser,
                            )
                            
@@ -126,9 +180,9 @@ class MercuryiPS(VisaInstrument):
                            )
         self.add_parameter(name="switch_heater",
                            label="Magnet switch_heater",
-                           get_cmd=f'READ:DEV:{self.uid}:{self.psu_string}:SIG:SWHT',
+                           get_cmd=self._cached_get(self._cmd['swht_get']),
                            get_parser=self._preparser,
-                           set_cmd=lambda x: self.ask(f'SET:DEV:{self.uid}:{self.psu_string}:SIG:SWHT:{x}'),
+                           set_cmd=lambda x: self._set(self._cmd['swht_set'] + str(x)),
                            )
                            
         self.connect_message()
@@ -136,11 +190,90 @@ class MercuryiPS(VisaInstrument):
     def _preparser(self, bare_resp: str) -> str:
         return bare_resp.split(':')[-1]
         
+    def _actn_parser(self, bare_resp: str) -> str:
+        tail = bare_resp.rpartition(':')[2]
+        return _ACTN_REV.get(tail, tail)
+        
     def _singleunit_parser(self, value: str):
-        return float(value.split(':')[-1][:-1])
+        match = _NUM_RE.search(value)
+        if match is None:
+            raise ValueError(f'Cannot parse a number from reply: {value}')
+        return float(match.group(1))
+        
+    # The unit is not part of the match, so rates parse the same way
+    _rate_parser = _singleunit_parser
+        
+    def _fset_cmd(self, target) -> str:
+        return self._cmd['fset_set'] + _fmt(target)
+        
+    def _ask_uncached(self, cmd: str) -> str:
+        return self.ask(cmd)
+        
+    def _cached_get(self, cmd: str):
+        """Build a get_cmd that reuses a reply younger than read_ttl"""
+        def get():
+            now = time.monotonic()
+            cached = self._reply_cache.get(cmd)
+            if cached is not None and now - cached[0] < self.read_ttl:
+                return cached[1]
+            value = self._ask_uncached(cmd)
+            self._reply_cache[cmd] = (now, value)
+            return value
+        return get
+        
+    def _set(self, cmd: str) -> str:
+        self._reply_cache.clear()
+        return self.ask(cmd)
         
-    def _rate_parser(self, value: str):
-        return float(value.split(':')[-1][:-3]) 
+    def ask_raw(self, cmd: str) -> str:
+        with self._io_lock:
+            return super().ask_raw(cmd)
+        
+    def _submit(self, cmds) -> list:
+        """
+        Send several commands in a single VISA write and collect the replies
+        afterwards (the instrument answers one line per command), so the
+        round-trip is paid only once.
+        """
+        msg = '\n'.join(cmds) + '\n'
+        if 'SET:' in msg:
+            self._reply_cache.clear()
+        with self._io_lock:
+            self.visa_handle.write_raw(msg.encode('ascii'))
+            try:
+                return [self.visa_handle.read() for _ in cmds]
+            except BaseException:
+                # Drop the replies still queued (also on Ctrl-C), otherwise
+                # the next query would get one of them as its answer
+                self.visa_handle.clear()
+                raise
+        
+    def _multi_read(self, signals, sets=()) -> dict:
+        """
+        Read several signals in a single VISA transaction. SET commands in
+        sets are sent ahead of the reads in the same write and their
+        acknowledgements are checked.
+        """
+        cmds = [*sets, *(self._read_cmds[sig] for sig in signals)]
+        try:
+            replies = self._submit(cmds)
+            for cmd, reply in zip(cmds, replies):
+                # The instrument echoes the command after 'STAT:', without
+                # the 'READ:' of a query
+                echo = 'STAT:' + (cmd[5:] if cmd.startswith('READ:') else cmd)
+                if not reply.startswith(echo):
+                    self.visa_handle.clear()
+                    raise RuntimeError(f'Reply {reply!r} does not match command {cmd!r}')
+            for ack in replies[:len(sets)]:
+                if not ack.endswith(':VALID'):
+                    raise RuntimeError(f'Command not accepted by the instrument: {ack}')
+        except BaseException:
+            if sets:
+                # e.g. a rejected FSET with an accepted RTOS would ramp to the
+                # old target with nobody watching the magnet temperature
+                self._set(self._cmd['actn_set'] + 'HOLD')
+            raise
+        return dict(zip(signals, replies[len(sets):]))
         
     def t_limit_setter(self, limit) -> None:
         self.t_limit = limit
@@ -148,42 +281,115 @@ class MercuryiPS(VisaInstrument):
     def t_limit_reader(self):
         return self.t_limit
     
-    def switch_heater_on_and_wait(self) -> None:
-        if (self.switch_heater()=='OFF'):
-            self.switch_heater('ON')
-            time.sleep(60*10)
+    def switch_heater_on_and_wait(self, wait: float = 600) -> None:
+        """
+        Switch the heater on and wait for the superconducting switch to warm
+        up. The instrument reports SWHT ON as soon as the command is accepted
+        and has no signal for the switch being open, so this waits a fixed
+        time (wait, in seconds) and then checks the heater state once.
+        """
+        if (self.switch_heater()!='OFF'):
+            return
+        if wait < 0:
+            raise ValueError(f'wait must be non-negative, got {wait}')
+        self.switch_heater('ON')
+        time.sleep(wait)
+        heater = self.switch_heater()
+        if (heater!='ON'):
+            raise RuntimeError(f'Switch heater is {heater} after waiting {wait} s')
+    
+    def _check_switch_heater(self) -> None:
+        heater = self.switch_heater()
+        if (heater=='OFF'):
+            raise RuntimeError(f'Switch heater is {heater}. '
+                               'Use switch_heater_on_and_wait() first.')
     
     def set_field_and_ramp_blocking(self, target: float) -> None:
         """Convenient method to combine setting target and ramping"""
-        if (self.switch_heater()=='OFF'):
-            raise print('Switch heater is off. Use switch_heater_on_and_wait() function.')
+        self._check_switch_heater()
         
         start = self.field()
         self.field_target(target)
-        self.ramp_to_target()
-        while self.ramp_status() == 'TO SET':
-            if (self.temp() > self.temp_limit()):
+        self._prepare_ramp()
+        # The ramp is started together with the first status poll
+        self._wait_for_ramp(start, target, (self._cmd['actn_set'] + 'RTOS',))
+        
+    def sweep_field(self, targets: Sequence[float],
+                    settle: float = 0.0) -> Iterator[float]:
+        """
+        Ramp through a list of field setpoints, yielding the field reached
+        at each of them. The new target and the ramp start are sent together
+        with the first status poll of every setpoint. settle is an extra
+        wait in seconds once a setpoint is reached.
+
+        How to use:
+            for reached in ips.sweep_field([0.1, 0.2, 0.3]):
+                ...
+        """
+        for target in targets:
+            self.field.validate(target)
+        self._check_switch_heater()
+        self._prepare_ramp()
+        start = self.field()
+        for target in targets:
+            sets = (self._fset_cmd(target),
+                    self._cmd['actn_set'] + 'RTOS')
+            reached = self._wait_for_ramp(start, target, sets)
+            # FSET went out raw, keep the parameter caches in sync
+            self.field_target.cache.set(target)
+            self.field.cache.set(reached)
+            if settle:
+                time.sleep(settle)
+            yield reached
+            start = reached
+            
+    def _wait_for_ramp(self, start: float, target: float, sets=()) -> float:
+        """
+        Poll the ramp until the PS leaves the TO SET state, stopping it if
+        the magnet temperature exceeds t_limit. The SET commands in sets are
+        sent with the first poll. Returns the last field reading.
+        """
+        while True:
+            state = self._multi_read(('ACTN', 'TEMP', 'FLD'), sets)
+            sets = ()
+            status_str = self._actn_parser(state['ACTN'])
+            temp_v = self._singleunit_parser(state['TEMP'])
+            fld_v = self._singleunit_parser(state['FLD'])
+            if status_str != 'TO SET':
+                return fld_v
+            if (temp_v > self.t_limit):
                 self.ramp_status('HOLD')
-                raise ValueError('Magnet ramp stopped since its temperature'
-                    'exceeded the safety limit:'
-                    f'Temperature safety limit = {self.temp_limit()}'
-                    f'Temperature reached = {self.temp()}')
+                raise ValueError('Magnet ramp stopped since its temperature '
+                    'exceeded the safety limit: '
+                    f'Temperature safety limit = {self.t_limit}, '
+                    f'Temperature reached = {temp_v}')
+            self._print_field_status(start, fld_v, target)
             time.sleep(0.1)
-            self._print_field_status(start, self.field(), target)
             
     def _print_field_status(self, start, current, stop):
-        status = abs((start - current) / (start - stop))
+        # Printed at most every 0.4 s, the poll loop runs faster than that
+        now = time.monotonic()
+        if now - self._last_print < 0.4:
+            return
+        self._last_print = now
+        status = abs((start - current) / (start - stop)) if start != stop else 1
         if status < 1:
-            tqdm.write(f"Magnetic field ramp {status*100:.1f}% done" + 30 * ' ', end='\r')
+            msg = f"Magnetic field ramp {status*100:.1f}% done"
         else:
-            tqdm.write('Waiting for field stabilization' + 30 * ' ', end='\r')
+            msg = 'Waiting for field stabilization'
+        sys.stderr.write(msg + _PAD + '\r')
+        sys.stderr.flush()
+
+    def _prepare_ramp(self) -> None:
+        """A clamped PS has to be put on hold before it can ramp"""
+        status = self.ramp_status()
+        if status == 'CLAMP':
+            self.ramp_status('HOLD')
 
     def ramp_to_target(self) -> None:
         """
         Unconditionally ramp this PS to its target
         """
-        status = self.ramp_status()
-        if status == 'CLAMP':
-            self.ramp_status('HOLD')
+        self._prepare_ramp()
         self.ramp_status('TO SET')
        
\ No newline at end of file